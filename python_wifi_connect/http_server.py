@@ -185,8 +185,9 @@ def RequestHandlerClassFactory(address, ssids, rcode):
                 # Update the list of SSIDs since we are not connected
                 self.ssids = netman.get_list_of_access_points()
 
-                # Start the hotspot again
-                netman.start_hotspot() 
+                # Start the hotspot again, in the background so we don't
+                # hold up this request for the activation.
+                netman.submit_start_hotspot()
 
     return  MyHTTPReqHandler # the class our factory just created.
 
@@ -195,6 +196,8 @@ def RequestHandlerClassFactory(address, ssids, rcode):
 # Create the hotspot, start dnsmasq, start the HTTP server.
 def main(address, port, ui_path, rcode, delete_connections):
 
+    netman.init_logging("netman.log")
+
     # See if caller wants to delete all existing connections first
     if delete_connections:
         netman.delete_all_wifi_connections()
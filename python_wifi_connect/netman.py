@@ -4,20 +4,177 @@
 # to see the DBUS API that the python-NetworkManager module is communicating
 # over (the module documentation is scant).
 
+import errno
 import os
+import select
 import socket
+import sys
+import threading
 import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import NetworkManager
 from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
 from loguru import logger
 
-logger.add("netman.log", retention="15 days")
+# D-Bus signals are delivered through a GLib main loop, which has to be the
+# default before any bus connection is made.  Only install it once, even if
+# the module gets reloaded.
+_mainloop_set = globals().get("_mainloop_set", False)
+if not _mainloop_set:
+    DBusGMainLoop(set_as_default=True)
+    _mainloop_set = True
+
+# Stay quiet until the application asks for logs, see init_logging().
+logger.disable(__name__)
+_log_sink_id = globals().get("_log_sink_id")  # survive importlib.reload()
 
 
 HOTSPOT_CONNECTION_NAME = "hotspot"
 GENERIC_CONNECTION_NAME = "python-wifi-connect"
+HOTSPOT_SSID = "PFC_EDU-" + os.environ.get("RESIN_DEVICE_NAME_AT_INIT", "aged-cheese")
+
+# Every NetworkManager lookup is a blocking D-Bus round trip, so keep the
+# connection list for a short while instead of re-listing it on every
+# call.  Invalidated whenever we add or delete a connection.
+NM_CACHE_TTL = 2.0  # seconds
+_nm_cache = {}
+
+
+def _cached(key, fetch):
+    """Return the cached value for key, calling fetch() if missing or stale."""
+    now = time.monotonic()
+    entry = _nm_cache.get(key)
+    if entry is not None and now - entry[0] < NM_CACHE_TTL:
+        return entry[1]
+    value = fetch()
+    _nm_cache[key] = (now, value)
+    return value
+
+
+def _invalidate_nm_cache():
+    """Forget everything we know about NetworkManager connections."""
+    _nm_cache.clear()
+
+
+def _connection_settings(conn) -> dict:
+    """Return the GetSettings() dict of a connection, fetched at most once per cache window."""
+    settings = _cached("settings", dict)
+    if conn.object_path not in settings:
+        settings[conn.object_path] = conn.GetSettings()
+    return settings[conn.object_path]
+
+
+def _list_connections_cached() -> list:
+    """Return [(id, type, connection)] for all known connections."""
+
+    def fetch():
+        result = []
+        for conn in NetworkManager.Settings.ListConnections():
+            settings = _connection_settings(conn).get("connection", {})
+            result.append((settings.get("id"), settings.get("type"), conn))
+        return result
+
+    return _cached("connections", fetch)
+
+
+# NetworkManager devices indexed by DeviceType.  Devices rarely come and go,
+# so the index is kept until NetworkManager signals a DeviceAdded or
+# DeviceRemoved.  Signals are only dispatched while a GLib loop runs, so the
+# index is also dropped after DEVICE_INDEX_TTL and whenever a D-Bus call on
+# one of its devices fails (e.g. after NetworkManager restarted).
+DEVICE_INDEX_TTL = 30.0  # seconds
+_device_index = None  # (time built, index)
+_device_signal_matches = []
+
+
+def _drop_device_index(*args):
+    global _device_index
+    _device_index = None
+
+
+def _devices_by_type() -> dict:
+    """Return {DeviceType: [device, ...]} for all NetworkManager devices."""
+    global _device_index
+    if not _device_signal_matches:
+        for signal in ("DeviceAdded", "DeviceRemoved"):
+            _device_signal_matches.append(
+                NetworkManager.NetworkManager.proxy.connect_to_signal(
+                    signal,
+                    _drop_device_index,
+                    dbus_interface="org.freedesktop.NetworkManager",
+                )
+            )
+    now = time.monotonic()
+    if _device_index is None or now - _device_index[0] >= DEVICE_INDEX_TTL:
+        index = {}
+        for dev in NetworkManager.NetworkManager.GetDevices():
+            index.setdefault(dev.DeviceType, []).append(dev)
+        _device_index = (now, index)
+    return _device_index[1]
+
+
+# All our GLib loops share the default main context, and a signal callback
+# runs on whichever thread happens to be iterating it.  Hold this lock from
+# subscribing to a signal until unsubscribing, so that only one thread at a
+# time waits on NetworkManager (e.g. a hotspot start on the _EXEC worker
+# and a stop_hotspot() from the main thread).
+_NM_LOOP_LOCK = threading.RLock()
+
+
+def _run_loop(loop, timeout):
+    """Run a GLib main loop until it is quit or timeout seconds have passed."""
+    timed_out = []
+
+    def on_timeout():
+        timed_out.append(True)
+        loop.quit()
+        return False  # one shot
+
+    source = GLib.timeout_add_seconds(timeout, on_timeout)
+    loop.run()
+    if not timed_out:
+        GLib.source_remove(source)
+
+
+def _delete_connections(connections, timeout=2):
+    """Delete connections and wait (at most timeout seconds) for NetworkManager
+    to confirm with a ConnectionRemoved signal for each of them."""
+    with _NM_LOOP_LOCK:
+        pending = {conn.object_path for conn in connections}
+        loop = GLib.MainLoop()
+
+        def on_connection_removed(path):
+            pending.discard(path)
+            if not pending:
+                loop.quit()
+
+        match = NetworkManager.Settings.proxy.connect_to_signal(
+            "ConnectionRemoved",
+            on_connection_removed,
+            dbus_interface="org.freedesktop.NetworkManager.Settings",
+        )
+        try:
+            for conn in connections:
+                conn.Delete()
+            # The signals queued up during the Delete() calls are only
+            # dispatched once the loop runs.
+            if pending:
+                _run_loop(loop, timeout)
+        finally:
+            match.remove()
+            _invalidate_nm_cache()
+
+
+def init_logging(path=None):
+    """Enable this module's logs, call once from the application's main.
+    If path is given, also send them to that file (the sink is only added once)."""
+    global _log_sink_id
+    logger.enable(__name__)
+    if path is not None and _log_sink_id is None:
+        _log_sink_id = logger.add(path, retention="15 days")
 
 
 def have_active_internet_connection(host="8.8.8.8", port=53, timeout=2)->bool:
@@ -27,145 +184,230 @@ def have_active_internet_connection(host="8.8.8.8", port=53, timeout=2)->bool:
     OpenPort: 53/tcp
     Service: domain (DNS/TCP)
     """
+    # Non-blocking connect so we don't touch the process wide default timeout.
+    s = None
     try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        err = s.connect_ex((host, port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return False
+        _, writable, _ = select.select([], [s], [], timeout)
+        if not writable:
+            return False  # timed out
+        return s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
     except Exception as e:
         # logger.debug(f"Exception: {e}")
         return False
+    finally:
+        if s is not None:
+            s.close()
 
 
 def delete_all_wifi_connections():
     """Remove ALL wifi connections - to start clean or before running the hotspot."""
-    # Get all known connections
-    connections = NetworkManager.Settings.ListConnections()
+    # Pick the '802-11-wireless' connections out of the known ones, each
+    # connection's settings are fetched at most once.
+    wifi_connections = []
+    for conn_id, conn_type, conn in _list_connections_cached():
+        if conn_type == "802-11-wireless":
+            logger.debug("Deleting connection {}", conn_id)
+            wifi_connections.append(conn)
+    _delete_connections(wifi_connections)
+
+
+# Rapid start/stop requests (e.g. repeated clicks in the UI) would each run
+# a full NetworkManager sequence.  Callers arriving while the same operation
+# is already in progress wait for it and share its result instead.
+_HOTSPOT_LOCK = threading.Lock()
+_HOTSPOT_FUTURES = {}  # operation name -> Future of the run in progress
+
+
+def _coalesce(name, func):
+    """Run func(), or wait for the run of the same name already in progress."""
+    with _HOTSPOT_LOCK:
+        future = _HOTSPOT_FUTURES.get(name)
+        owner = future is None or future.done()
+        if owner:
+            future = _HOTSPOT_FUTURES[name] = Future()
+    if not owner:
+        return future.result()
 
-    # Delete the '802-11-wireless' connections
-    for connection in connections:
-        if connection.GetSettings()["connection"]["type"] == "802-11-wireless":
-            logger.debug(
-                "Deleting connection " + connection.GetSettings()["connection"]["id"]
-            )
-            connection.Delete()
-    time.sleep(2)
+    try:
+        result = func()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    future.set_result(result)
+    return result
 
 
 def stop_hotspot():
     """Stop and delete the hotspot.
     Returns True for success or False (for hotspot not found or error)."""
-    return stop_connection(HOTSPOT_CONNECTION_NAME)
+    return _coalesce("stop", lambda: stop_connection(HOTSPOT_CONNECTION_NAME))
 
 
 def stop_connection(conn_name=GENERIC_CONNECTION_NAME) -> bool:
     """Generic connection stopper / deleter."""
     # Find the hotspot connection
     try:
-        connections = NetworkManager.Settings.ListConnections()
-        connections = dict(
-            [(x.GetSettings()["connection"]["id"], x) for x in connections]
-        )
+        connections = {
+            conn_id: conn for conn_id, _, conn in _list_connections_cached()
+        }
         conn = connections[conn_name]
-        conn.Delete()
+        _delete_connections([conn])
     except Exception as e:
         # logger.debug(f'stop_hotspot error {e}')
+        _invalidate_nm_cache()
         return False
-    time.sleep(2)
     return True
 
 
-def get_list_of_access_points(hidden_placeholder: bool = True)->[]:
-    """Return a list of available SSIDs and their security type, or [] for none available or error."""
-    # bit flags we use when decoding what we get back from NetMan for each AP
-    NM_SECURITY_NONE = 0x0
-    NM_SECURITY_WEP = 0x1
-    NM_SECURITY_WPA = 0x2
-    NM_SECURITY_WPA2 = 0x4
-    NM_SECURITY_ENTERPRISE = 0x8
-
-    ssids = []  # list we return
-
-    for dev in NetworkManager.NetworkManager.GetDevices():
-        if dev.DeviceType != NetworkManager.NM_DEVICE_TYPE_WIFI:
-            continue
-        for ap in dev.GetAccessPoints():
-
-            # Get Flags, WpaFlags and RsnFlags, all are bit OR'd combinations
-            # of the NM_802_11_AP_SEC_* bit flags.
-            # https://developer.gnome.org/NetworkManager/1.2/nm-dbus-types.html#NM80211ApSecurityFlags
-
-            security = NM_SECURITY_NONE
+def _access_point_properties(ap) -> dict:
+    """Fetch all properties of an AccessPoint in one D-Bus round trip.
 
-            # Based on a subset of the flag settings we can determine which
-            # type of security this AP uses.
-            # We can also determine what input we need from the user to connect to
-            # any given AP (required for our dynamic UI form).
-            if (
-                ap.Flags & NetworkManager.NM_802_11_AP_FLAGS_PRIVACY
-                and ap.WpaFlags == NetworkManager.NM_802_11_AP_SEC_NONE
-                and ap.RsnFlags == NetworkManager.NM_802_11_AP_SEC_NONE
-            ):
-                security = NM_SECURITY_WEP
-
-            if ap.WpaFlags != NetworkManager.NM_802_11_AP_SEC_NONE:
-                security = NM_SECURITY_WPA
-
-            if ap.RsnFlags != NetworkManager.NM_802_11_AP_SEC_NONE:
-                security = NM_SECURITY_WPA2
+    Values are the raw dbus types, e.g. Ssid is an array of bytes rather
+    than the str python-networkmanager would give us.
+    """
+    return ap.proxy.GetAll(
+        "org.freedesktop.NetworkManager.AccessPoint",
+        dbus_interface="org.freedesktop.DBus.Properties",
+    )
 
-            if (
-                ap.WpaFlags & NetworkManager.NM_802_11_AP_SEC_KEY_MGMT_802_1X
-                or ap.RsnFlags & NetworkManager.NM_802_11_AP_SEC_KEY_MGMT_802_1X
-            ):
-                security = NM_SECURITY_ENTERPRISE
 
-            # logger.debug(f'{ap.Ssid:15} Flags=0x{ap.Flags:X} WpaFlags=0x{ap.WpaFlags:X} RsnFlags=0x{ap.RsnFlags:X}')
+def _request_scan(dev):
+    """Ask NetworkManager to rescan a wifi device, without waiting for the reply."""
+    try:
+        dev.proxy.RequestScan(
+            {},
+            dbus_interface="org.freedesktop.NetworkManager.Device.Wireless",
+            ignore_reply=True,
+        )
+    except Exception as e:
+        logger.debug("RequestScan error {}", e)
 
-            # Decode our flag into a display string
-            security_str = ""
-            if security == NM_SECURITY_NONE:
-                security_str = "NONE"
 
-            if security & NM_SECURITY_WEP:
-                security_str = "WEP"
+def _scan_device(dev) -> list:
+    """Return the properties of every AP a wifi device can see, or [] on error."""
+    try:
+        access_points = dev.GetAccessPoints()
+    except Exception as e:
+        logger.debug("Scan error {}", e)
+        _drop_device_index()
+        return []
 
-            if security & NM_SECURITY_WPA:
-                security_str = "WPA"
+    result = []
+    for ap in access_points:
+        # APs routinely vanish mid-scan, skip just the one that went away.
+        try:
+            result.append(_access_point_properties(ap))
+        except Exception as e:
+            logger.debug("Skipping access point {}: {}", ap.object_path, e)
+    return result
 
-            if security & NM_SECURITY_WPA2:
-                security_str = "WPA2"
 
-            if security & NM_SECURITY_ENTERPRISE:
-                security_str = "ENTERPRISE"
+# Security display strings, shared by every AP entry we build.
+_SEC_NONE = sys.intern("NONE")
+_SEC_WEP = sys.intern("WEP")
+_SEC_WPA = sys.intern("WPA")
+_SEC_WPA2 = sys.intern("WPA2")
+_SEC_ENT = sys.intern("ENTERPRISE")
 
-            entry = {"ssid": ap.Ssid, "security": security_str}
 
-            # Don't add duplicates to the list, issue #8
-            if ssids.__contains__(entry):
-                continue
+def _classify(flags, wpa_flags, rsn_flags) -> str:
+    """Return the security type of an AP as a display string.
 
-            # Don't add other PFC's to the list!
-            if ap.Ssid.startswith("PFC_EDU-"):
-                continue
+    Flags, WpaFlags and RsnFlags are all bit OR'd combinations of the
+    NM_802_11_AP_SEC_* bit flags.
+    https://developer.gnome.org/NetworkManager/1.2/nm-dbus-types.html#NM80211ApSecurityFlags
 
-            ssids.append(entry)
+    The security type also tells us what input we need from the user to
+    connect to any given AP (required for our dynamic UI form).
+    """
+    if (wpa_flags | rsn_flags) & NetworkManager.NM_802_11_AP_SEC_KEY_MGMT_802_1X:
+        return _SEC_ENT
+    if rsn_flags != NetworkManager.NM_802_11_AP_SEC_NONE:
+        return _SEC_WPA2
+    if wpa_flags != NetworkManager.NM_802_11_AP_SEC_NONE:
+        return _SEC_WPA
+    if flags & NetworkManager.NM_802_11_AP_FLAGS_PRIVACY:
+        return _SEC_WEP
+    return _SEC_NONE
+
+
+def _iter_access_points(hidden_placeholder: bool = True):
+    """Yield available SSIDs and their security type as they are classified."""
+    seen = set()  # (ssid, security) pairs already yielded
+
+    devices = _devices_by_type().get(NetworkManager.NM_DEVICE_TYPE_WIFI, [])
+    if devices:
+        # Kick off a fresh scan on every radio without waiting for the
+        # replies, then read each device's AP list in parallel.  Each
+        # device's APs are yielded as soon as its list is in.
+        for dev in devices:
+            _request_scan(dev)
+        with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+            for access_points in executor.map(_scan_device, devices):
+                for props in access_points:
+                    # Work on the raw SSID bytes, we only decode the ones we keep.
+                    raw_ssid = bytes(props["Ssid"])
+
+                    # Don't add other PFC's to the list!
+                    if raw_ssid.startswith(b"PFC_EDU-"):
+                        continue
+
+                    # logger.debug(f'{raw_ssid!r:15} Flags=0x{props["Flags"]:X} WpaFlags=0x{props["WpaFlags"]:X} RsnFlags=0x{props["RsnFlags"]:X}')
+                    security_str = _classify(
+                        props["Flags"], props["WpaFlags"], props["RsnFlags"]
+                    )
+
+                    # Don't add duplicates to the list, issue #8
+                    key = (raw_ssid, security_str)
+                    if key in seen:
+                        continue
+
+                    seen.add(key)
+                    ssid = raw_ssid.decode("utf-8", "replace")
+                    yield {"ssid": ssid, "security": security_str}
 
     if hidden_placeholder:
-        ssids.append({"ssid": "Enter a hidden WiFi name", "security": "HIDDEN"})
+        yield {"ssid": "Enter a hidden WiFi name", "security": "HIDDEN"}
 
-    logger.debug(f"Available SSIDs: {ssids}")
+
+def get_list_of_access_points(hidden_placeholder: bool = True)->[]:
+    """Return a list of available SSIDs and their security type, or [] for none available or error."""
+    ssids = list(_iter_access_points(hidden_placeholder))
+    logger.opt(lazy=True).debug("Available SSIDs: {}", lambda: ssids)
     return ssids
 
 
 def get_hotspot_SSID()->str:
     """Get hotspot SSID name."""
-    return "PFC_EDU-" + os.getenv("RESIN_DEVICE_NAME_AT_INIT", "aged-cheese")
+    return HOTSPOT_SSID
 
 
 def start_hotspot()->bool:
     """Start a local hotspot on the wifi interface.
     Returns True for success, False for error."""
-    return connect_to_AP(CONN_TYPE_HOTSPOT, HOTSPOT_CONNECTION_NAME, get_hotspot_SSID())
+    return _coalesce(
+        "start",
+        lambda: connect_to_AP(
+            CONN_TYPE_HOTSPOT, HOTSPOT_CONNECTION_NAME, get_hotspot_SSID()
+        ),
+    )
+
+
+# Activating a connection can block for up to 30 seconds, callers that can't
+# afford that (e.g. an HTTP request handler) run it on this worker instead.
+# A single worker keeps NetworkManager operations in submission order.
+_EXEC = ThreadPoolExecutor(max_workers=1)
+
+
+def submit_start_hotspot() -> Future:
+    """Start the hotspot on a worker thread.
+    Returns a Future whose result is start_hotspot()'s."""
+    return _EXEC.submit(start_hotspot)
 
 
 # ------------------------------------------------------------------------------
@@ -176,6 +418,96 @@ CONN_TYPE_SEC_PASSWORD = "PASSWORD"  # WPA, WPA2 and WEP
 CONN_TYPE_SEC_ENTERPRISE = "ENTERPRISE"  # MIT SECURE
 
 
+def _connection_section(conn_name, extra=None) -> dict:
+    """The "connection" settings shared by all our wifi connections, plus any
+    extra ones.  The new connection's UUID is generated here, once per connect."""
+    section = {
+        "id": conn_name,
+        "type": "802-11-wireless",
+        "uuid": str(uuid.uuid4()),
+    }
+    if extra:
+        section.update(extra)
+    return section
+
+
+def _build_hotspot(conn_name, ssid, username, password) -> dict:
+    """This is the hotspot that we turn on, on the RPI so we can show our
+    captured portal to let the user select an AP and provide credentials."""
+    return {
+        "802-11-wireless": {"band": "bg", "mode": "ap", "ssid": ssid},
+        "connection": _connection_section(
+            conn_name, {"autoconnect": False, "interface-name": "wlan0"}
+        ),
+        "ipv4": {
+            "address-data": [{"address": "192.168.42.1", "prefix": 24}],
+            "addresses": [["192.168.42.1", 24, "0.0.0.0"]],
+            "method": "manual",
+        },
+        "ipv6": {"method": "auto"},
+    }
+
+
+# debugrob: is this realy a generic ENTERPRISE config, need another?
+# debugrob: how do we handle connecting to a captured portal?
+
+
+def _build_enterprise(conn_name, ssid, username, password) -> dict:
+    """This is what we use for "MIT SECURE" network."""
+    return {
+        "802-11-wireless": {
+            "mode": "infrastructure",
+            "security": "802-11-wireless-security",
+            "ssid": ssid,
+        },
+        "802-11-wireless-security": {"auth-alg": "open", "key-mgmt": "wpa-eap"},
+        "802-1x": {
+            "eap": ["peap"],
+            "identity": username,
+            "password": password,
+            "phase2-auth": "mschapv2",
+        },
+        "connection": _connection_section(conn_name),
+        "ipv4": {"method": "auto"},
+        "ipv6": {"method": "auto"},
+    }
+
+
+def _build_none(conn_name, ssid, username, password) -> dict:
+    """No auth, 'open' connection."""
+    return {
+        "802-11-wireless": {"mode": "infrastructure", "ssid": ssid},
+        "connection": _connection_section(conn_name),
+        "ipv4": {"method": "auto"},
+        "ipv6": {"method": "auto"},
+    }
+
+
+def _build_password(conn_name, ssid, username, password) -> dict:
+    """Hidden, WEP, WPA, WPA2, password required."""
+    return {
+        "802-11-wireless": {
+            "mode": "infrastructure",
+            "security": "802-11-wireless-security",
+            "ssid": ssid,
+        },
+        "802-11-wireless-security": {"key-mgmt": "wpa-psk", "psk": password},
+        "connection": _connection_section(conn_name),
+        "ipv4": {"method": "auto"},
+        "ipv6": {"method": "auto"},
+    }
+
+
+# conn_type -> (display string, settings builder), only the chosen settings
+# dict gets built.
+_BUILDERS = {
+    CONN_TYPE_HOTSPOT: ("HOTSPOT", _build_hotspot),
+    CONN_TYPE_SEC_NONE: ("OPEN", _build_none),
+    CONN_TYPE_SEC_PASSWORD: ("WEP/WPA/WPA2", _build_password),
+    CONN_TYPE_SEC_ENTERPRISE: ("ENTERPRISE", _build_enterprise),
+}
+
+
 def connect_to_AP(
     conn_type=None,
     conn_name=GENERIC_CONNECTION_NAME,
@@ -188,180 +520,110 @@ def connect_to_AP(
     # logger.debug(f"connect_to_AP conn_type={conn_type} conn_name={conn_name} ssid={ssid} username={username} password={password}")
 
     if conn_type is None or ssid is None:
-        logger.debug(f"connect_to_AP() Error: Missing args conn_type or ssid")
+        logger.debug("connect_to_AP() Error: Missing args conn_type or ssid")
         return False
 
-    try:
-        # This is the hotspot that we turn on, on the RPI so we can show our
-        # captured portal to let the user select an AP and provide credentials.
-        hotspot_dict = {
-            "802-11-wireless": {"band": "bg", "mode": "ap", "ssid": ssid},
-            "connection": {
-                "autoconnect": False,
-                "id": conn_name,
-                "interface-name": "wlan0",
-                "type": "802-11-wireless",
-                "uuid": str(uuid.uuid4()),
-            },
-            "ipv4": {
-                "address-data": [{"address": "192.168.42.1", "prefix": 24}],
-                "addresses": [["192.168.42.1", 24, "0.0.0.0"]],
-                "method": "manual",
-            },
-            "ipv6": {"method": "auto"},
-        }
-
-        # debugrob: is this realy a generic ENTERPRISE config, need another?
-        # debugrob: how do we handle connecting to a captured portal?
-
-        # This is what we use for "MIT SECURE" network.
-        enterprise_dict = {
-            "802-11-wireless": {
-                "mode": "infrastructure",
-                "security": "802-11-wireless-security",
-                "ssid": ssid,
-            },
-            "802-11-wireless-security": {"auth-alg": "open", "key-mgmt": "wpa-eap"},
-            "802-1x": {
-                "eap": ["peap"],
-                "identity": username,
-                "password": password,
-                "phase2-auth": "mschapv2",
-            },
-            "connection": {
-                "id": conn_name,
-                "type": "802-11-wireless",
-                "uuid": str(uuid.uuid4()),
-            },
-            "ipv4": {"method": "auto"},
-            "ipv6": {"method": "auto"},
-        }
-
-        # No auth, 'open' connection.
-        none_dict = {
-            "802-11-wireless": {"mode": "infrastructure", "ssid": ssid},
-            "connection": {
-                "id": conn_name,
-                "type": "802-11-wireless",
-                "uuid": str(uuid.uuid4()),
-            },
-            "ipv4": {"method": "auto"},
-            "ipv6": {"method": "auto"},
-        }
-
-        # Hidden, WEP, WPA, WPA2, password required.
-        passwd_dict = {
-            "802-11-wireless": {
-                "mode": "infrastructure",
-                "security": "802-11-wireless-security",
-                "ssid": ssid,
-            },
-            "802-11-wireless-security": {"key-mgmt": "wpa-psk", "psk": password},
-            "connection": {
-                "id": conn_name,
-                "type": "802-11-wireless",
-                "uuid": str(uuid.uuid4()),
-            },
-            "ipv4": {"method": "auto"},
-            "ipv6": {"method": "auto"},
-        }
-
-        conn_dict = None
-        conn_str = ""
-        if conn_type == CONN_TYPE_HOTSPOT:
-            conn_dict = hotspot_dict
-            conn_str = "HOTSPOT"
-
-        if conn_type == CONN_TYPE_SEC_NONE:
-            conn_dict = none_dict
-            conn_str = "OPEN"
-
-        if conn_type == CONN_TYPE_SEC_PASSWORD:
-            conn_dict = passwd_dict
-            conn_str = "WEP/WPA/WPA2"
-
-        if conn_type == CONN_TYPE_SEC_ENTERPRISE:
-            conn_dict = enterprise_dict
-            conn_str = "ENTERPRISE"
+    if conn_type not in _BUILDERS:
+        logger.debug('connect_to_AP() Error: Invalid conn_type="{}"', conn_type)
+        return False
+    conn_str, builder = _BUILDERS[conn_type]
 
-        if conn_dict is None:
-            logger.debug(f'connect_to_AP() Error: Invalid conn_type="{conn_type}"')
-            return False
+    try:
+        conn_dict = builder(conn_name, ssid, username, password)
 
         # logger.debug(f"new connection {conn_dict} type={conn_str}")
 
-        NetworkManager.Settings.AddConnection(conn_dict)
-        logger.debug(f"Added connection {conn_name} of type {conn_str}")
-
-        # Now find this connection and its device
-        connections = NetworkManager.Settings.ListConnections()
-        connections = dict(
-            [(x.GetSettings()["connection"]["id"], x) for x in connections]
-        )
-        conn = connections[conn_name]
-
-        # Find a suitable device
-        ctype = conn.GetSettings()["connection"]["type"]
+        # Find a suitable device.  We know the connection type from the
+        # settings we're about to add, so there's no need to add the
+        # connection and then list them all to find it again.
+        ctype = conn_dict["connection"]["type"]
         dtype = {"802-11-wireless": NetworkManager.NM_DEVICE_TYPE_WIFI}.get(
             ctype, ctype
         )
-        devices = NetworkManager.NetworkManager.GetDevices()
-
-        for dev in devices:
-            if dev.DeviceType == dtype:
-                break
-        else:
+        dev = _devices_by_type().get(dtype, [None])[0]
+        if dev is None:
             logger.debug(
-                f"connect_to_AP() Error: No suitable and available {ctype} device found."
+                "connect_to_AP() Error: No suitable and available {} device found.",
+                ctype,
             )
             return False
 
-        # And connect
-        NetworkManager.NetworkManager.ActivateConnection(conn, dev, "/")
-        logger.debug(f"Activated connection={conn_name}.")
-
-        # Wait for ADDRCONF(NETDEV_CHANGE): wlan0: link becomes ready
-        logger.debug(f"Waiting for connection to become active...")
-        loop_count = 0
-        while dev.State != NetworkManager.NM_DEVICE_STATE_ACTIVATED:
-            # logger.debug(f'dev.State={dev.State}')
-            time.sleep(1)
-            loop_count += 1
-            if loop_count > 30:  # only wait 30 seconds max
-                break
+        with _NM_LOOP_LOCK:
+            # Wait for ADDRCONF(NETDEV_CHANGE): wlan0: link becomes ready.
+            # Subscribe before activating so we can't miss the transition.
+            loop = GLib.MainLoop()
+
+            def on_state_changed(new_state, old_state, reason):
+                # logger.debug(f'dev.State={new_state}')
+                if new_state in (
+                    NetworkManager.NM_DEVICE_STATE_ACTIVATED,
+                    NetworkManager.NM_DEVICE_STATE_FAILED,
+                ):
+                    loop.quit()
+
+            match = dev.proxy.connect_to_signal(
+                "StateChanged",
+                on_state_changed,
+                dbus_interface="org.freedesktop.NetworkManager.Device",
+            )
+            try:
+                # Add and connect in a single round trip
+                NetworkManager.NetworkManager.AddAndActivateConnection(
+                    conn_dict, dev, "/"
+                )
+                _invalidate_nm_cache()
+                logger.debug(
+                    "Added and activated connection {} of type {}.", conn_name, conn_str
+                )
+
+                logger.debug("Waiting for connection to become active...")
+                _run_loop(loop, 30)  # only wait 30 seconds max
+            finally:
+                match.remove()
 
         if dev.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
-            logger.debug(f"Connection {conn_name} is live.")
+            logger.debug("Connection {} is live.", conn_name)
             return True
 
     except Exception as e:
-        logger.debug(f"Connection error {e}")
+        logger.debug("Connection error {}", e)
+        _drop_device_index()
 
-    logger.debug(f"Connection {conn_name} failed.")
+    logger.debug("Connection {} failed.", conn_name)
     return False
 
 
-def get_active_access_point()->NetworkManager.AccessPoint:
-    """Return the active access point object from NetworkManager DBUS interface"""
-    # TODO: get rid of this trick the other code doesn't need it.
-    DBusGMainLoop(set_as_default=True)
+def connect_to_AP_async(*args, **kwargs) -> Future:
+    """Run connect_to_AP() on a worker thread, takes the same arguments.
+    Returns a Future whose result is connect_to_AP()'s."""
+    return _EXEC.submit(connect_to_AP, *args, **kwargs)
 
-    devices = [
-        device
-        for device in NetworkManager.NetworkManager.GetAllDevices()
-        if isinstance(device, NetworkManager.Wireless)
-    ]
-    logger.debug(f"All devices : {devices}")
-    # if len(device) == 1:
+
+def get_active_access_point()->NetworkManager.AccessPoint:
+    """Return the active access point object from NetworkManager DBUS interface,
+    or None if there is no wifi device."""
     # get the first wifi device
-    selected_device = devices[0]
+    selected_device = next(
+        (
+            device
+            for device in NetworkManager.NetworkManager.GetAllDevices()
+            if isinstance(device, NetworkManager.Wireless)
+        ),
+        None,
+    )
+    if selected_device is None:
+        logger.debug(" * No wifi device")
+        return None
     active_access_point = selected_device.ActiveAccessPoint
     if active_access_point:
-        logger.debug(f" * Active access point : {active_access_point.Ssid}")
+        logger.opt(lazy=True).debug(
+            " * Active access point : {}", lambda: active_access_point.Ssid
+        )
     else:
-        logger.debug(f" * No active access point")
+        logger.debug(" * No active access point")
     return active_access_point
 
 
 if __name__ == "__main__":
+    init_logging("netman.log")
     print(get_active_access_point())